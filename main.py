@@ -1,19 +1,40 @@
+import os
+import json
+import asyncio
+import httpx
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from decouple import config
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from pydantic import BaseModel
 
 class ChatRequest(BaseModel):
+    system: str | None = None
     message: str
 
 
 app = FastAPI()
 API_KEY = config('OPENAI_API_KEY')
 
-client = OpenAI(api_key = API_KEY)
+# OPENAI_CONCURRENCY is the account-wide limit, split evenly across the WORKERS
+# server processes; `python main.py` sets WORKERS for its workers, set it to match
+# --workers when launching uvicorn directly
+OPENAI_CONCURRENCY = config('OPENAI_CONCURRENCY', default=32, cast=int)
+WORKERS = config('WORKERS', default=1, cast=int)
+OPENAI_MAX_RETRIES = config('OPENAI_MAX_RETRIES', default=5, cast=int)
 
-class ChatRequest(BaseModel):
-    message: str
+# Pooled connections are shared by every request; the SDK retries 429s with
+# exponential backoff and honours Retry-After
+client = AsyncOpenAI(
+    api_key = API_KEY,
+    max_retries = OPENAI_MAX_RETRIES,
+    http_client = DefaultAsyncHttpxClient(
+        limits = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    )
+)
+
+# Bounds this process's in-flight completions to its share of the account quota
+openai_slots = asyncio.Semaphore(max(1, OPENAI_CONCURRENCY // WORKERS))
 
 
 @app.get("/")
@@ -24,20 +45,53 @@ def read_root():
 
 @app.post("/api/v1/chat/")
 async def chat_api(request: ChatRequest):
-    try:
-        message = request.message
-        
-        response = client.chat.completions.create(
-            model='gpt-4o',
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that provides accurate answers based on the given context."},
-                {"role": "user", "content": message}
-            ]
-        )
-        
-        text_response = response.choices[0].message.content
-        return {"response": text_response}
+    # A stable system message lets OpenAI's prompt cache reuse the prefix across turns
+    system = request.system or "You are a helpful assistant that provides accurate answers based on the given context."
+    message = request.message
+
+    async def event_source():
+        # Forward tokens as server-sent events as soon as OpenAI produces them
+        try:
+            async with openai_slots:
+                stream = await client.chat.completions.create(
+                    model='gpt-4o',
+                    messages=[
+                        {"role": "system", "content": system},
+                        {"role": "user", "content": message}
+                    ],
+                    stream=True
+                )
+                
+                # Closing the stream releases the pooled connection even when
+                # the client disconnects mid-answer and this generator is closed
+                async with stream:
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            yield f"data: {json.dumps({'response': chunk.choices[0].delta.content})}\n\n"
+            
+        except Exception as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
         
-    except Exception as e:
-        return {"error": str(e)}
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(event_source(), media_type='text/event-stream')
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Worker processes re-import this module, so they read their share from WORKERS
+    workers = config('WORKERS', default=os.cpu_count() or 1, cast=int)
+    os.environ['WORKERS'] = str(workers)
 
+    # uvloop and httptools replace the pure-Python event loop and HTTP parser;
+    # one worker process per core, each with its own loop and OpenAI client
+    uvicorn.run(
+        "main:app",
+        host = config('HOST', default='0.0.0.0'),
+        port = config('PORT', default=8000, cast=int),
+        uds = config('CHAT_API_SOCKET', default=None),
+        workers = workers,
+        loop = 'uvloop',
+        http = 'httptools'
+    )
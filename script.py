@@ -1,35 +1,235 @@
 import os
-import requests
+import glob
+import asyncio
+import argparse
+import httpx
 import speech_recognition as sr
 import ffmpeg
 import tempfile
-from pydub import AudioSegment
+import shutil
+import atexit
+import errno
 import wave
 import json
+import io
+import re
+import threading
+import functools
+import hashlib
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from decouple import config
+import numpy as np
+
+try:
+    import ctranslate2
+    from faster_whisper import WhisperModel, BatchedInferencePipeline
+except ImportError:
+    WhisperModel = None
+
+try:
+    from google.cloud import speech_v2, storage
+except ImportError:
+    speech_v2 = None
 
-# Initialize speech recognizer
-recognizer = sr.Recognizer()
 MEDIA_EXTENSIONS = {'.mp4', '.avi', '.mkv', '.mov', '.wmv', '.mp3', '.wav', '.flac', '.m4a', '.aac'}
+SAMPLE_RATE = 16000  # Hz, mono
+SAMPLE_WIDTH = 2  # bytes per sample (pcm_s16le)
+MAX_AUDIO_SIZE = 10 * 1024 * 1024  # 10MB limit for Google Speech Recognition
+COPY_BUFFER_SIZE = 1024 * 1024  # 1MB blocks when streaming ffmpeg output to disk
+FFMPEG_STDERR_TAIL = 50  # last ffmpeg stderr lines kept for error messages
+# A sentence ends at . ! or ? followed by whitespace, unless the word is a common abbreviation
+ABBREVIATIONS = ('Mr', 'Mrs', 'Ms', 'Dr', 'Prof', 'Sr', 'Jr', 'St', 'vs', 'etc', 'e.g', 'i.e')
+SENTENCE_BOUNDARY = re.compile(
+    r'(?<=[.!?])' + ''.join(rf'(?<!\b{re.escape(word)}\.)' for word in ABBREVIATIONS) + r'\s+'
+)
+# Temporary WAVs live in one per-run directory, on tmpfs when the system has it;
+# the disk temp directory ('') is used when tmpfs runs out of space
+WORKSPACE_ROOT = config('WORKSPACE_ROOT', default='/dev/shm' if os.path.isdir('/dev/shm') else '')
+# Parallel recognition requests allowed by the speech service quota
+TRANSCRIBE_CONCURRENCY = config('TRANSCRIBE_CONCURRENCY', default=8, cast=int)
 
-def extract_audio_from_video(video_path):
-    """Extract audio from video file using ffmpeg"""
+# Caps in-flight recognition requests across every chunk being transcribed
+transcription_slots = threading.Semaphore(TRANSCRIBE_CONCURRENCY)
+
+workspace_lock = threading.Lock()
+workspaces = {}
+
+def get_workspace(root):
+    """Create the per-run scratch directory under root on first use and remove it at exit"""
+    with workspace_lock:
+        if root not in workspaces:
+            workspaces[root] = tempfile.mkdtemp(prefix='chartie_', dir=root or None)
+            atexit.register(shutil.rmtree, workspaces[root], ignore_errors=True)
+        return workspaces[root]
+
+# Local Whisper backend (optional faster-whisper package), tried before the Google
+# services; 'auto' only uses it on a CUDA GPU, set WHISPER_DEVICE=cpu to opt in on CPU
+WHISPER_MODEL = config('WHISPER_MODEL', default='large-v3')
+WHISPER_DEVICE = config('WHISPER_DEVICE', default='auto')
+WHISPER_COMPUTE_TYPE = config('WHISPER_COMPUTE_TYPE', default='')  # '' picks one for the device
+WHISPER_BATCH_SIZE = config('WHISPER_BATCH_SIZE', default=16, cast=int)
+whisper_lock = threading.Lock()
+whisper_pipeline = None
+whisper_failed = WhisperModel is None
+
+def get_whisper_pipeline():
+    """Load the Whisper model once, or return None when it is unavailable"""
+    global whisper_pipeline, whisper_failed
+    with whisper_lock:
+        if whisper_pipeline is None and not whisper_failed:
+            try:
+                device = WHISPER_DEVICE
+                if device in ('auto', 'cuda'):
+                    # Check for a GPU first, loading downloads the weights before picking a device
+                    if ctranslate2.get_cuda_device_count() == 0:
+                        raise RuntimeError("no CUDA device found")
+                    device = 'cuda'
+                compute_type = WHISPER_COMPUTE_TYPE or ('int8' if device == 'cpu' else 'int8_float16')
+                
+                print(f"Loading Whisper {WHISPER_MODEL} on {device}...")
+                model = WhisperModel(WHISPER_MODEL, device=device, compute_type=compute_type)
+                whisper_pipeline = BatchedInferencePipeline(model=model)
+            except Exception as e:
+                print(f"Whisper unavailable, falling back to Google Speech Recognition: {e}")
+                whisper_failed = True
+        return whisper_pipeline
+
+# Chat API server, reached over a Unix socket instead of loopback TCP when one is set
+CHAT_API_URL = config('CHAT_API_URL', default='http://127.0.0.1:8000')
+CHAT_API_SOCKET = config('CHAT_API_SOCKET', default='')
+ANSWER_CACHE_SIZE = 512  # answers kept per session for repeated questions
+
+# Google Cloud BatchRecognize, used for chunked audio when a project and bucket are configured
+GOOGLE_CLOUD_PROJECT = config('GOOGLE_CLOUD_PROJECT', default='')
+GCS_BUCKET = config('GCS_BUCKET', default='')
+BATCH_RECOGNIZE_MAX_MS = 8 * 60 * 60 * 1000  # longest file BatchRecognize accepts
+BATCH_RECOGNIZE_TIMEOUT = config('BATCH_RECOGNIZE_TIMEOUT', default=3600, cast=int)  # seconds
+# Dynamic batching is cheaper but may queue jobs for hours, so it is opt-in
+BATCH_RECOGNIZE_DYNAMIC = config('BATCH_RECOGNIZE_DYNAMIC', default=False, cast=bool)
+
+# Content-addressed transcript cache shared by whole files and single chunks
+CACHE_PATH = os.path.expanduser(config('TRANSCRIPT_CACHE_PATH', default='~/.cache/chartie_transcripts.sqlite3'))
+CACHE_SIZE_LIMIT = config('TRANSCRIPT_CACHE_SIZE_LIMIT', default=2 * 1024 ** 3, cast=int)  # bytes of text
+HASH_BLOCK_SIZE = 1024 * 1024  # 1MB reads when hashing files
+cache_lock = threading.Lock()
+cache_db = None
+cache_size = 0  # running total of stored text, in UTF-8 bytes
+cache_stats = {'hits': 0, 'misses': 0}
+
+def get_cache_db():
+    """Open the transcript cache database, creating it on first use"""
+    global cache_db, cache_size
+    if cache_db is None:
+        if os.path.dirname(CACHE_PATH):
+            os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        db = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS transcripts (hash TEXT PRIMARY KEY, text TEXT, ts INTEGER)")
+        db.execute("CREATE INDEX IF NOT EXISTS transcripts_ts ON transcripts (ts)")
+        # Sized once here, then kept up to date by cache_set
+        cache_size = db.execute("SELECT COALESCE(SUM(LENGTH(CAST(text AS BLOB))), 0) FROM transcripts").fetchone()[0]
+        cache_db = db
+    return cache_db
+
+def cache_get(key):
+    """Return the cached transcription for key, or None on a miss"""
+    try:
+        with cache_lock:
+            db = get_cache_db()
+            row = db.execute("SELECT text FROM transcripts WHERE hash = ?", (key,)).fetchone()
+            if row is None:
+                cache_stats['misses'] += 1
+                return None
+            
+            cache_stats['hits'] += 1
+            db.execute("UPDATE transcripts SET ts = ? WHERE hash = ?", (time.time_ns(), key))
+            db.commit()
+            return row[0]
+    except (sqlite3.Error, OSError) as e:
+        print(f"Transcript cache unavailable: {e}")
+        return None
+
+def cache_set(key, text):
+    """Store a transcription, evicting least recently used entries over the size limit"""
+    global cache_size
     try:
-        # Create temporary WAV file
-        temp_audio = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-        temp_audio_path = temp_audio.name
-        temp_audio.close()
+        with cache_lock:
+            db = get_cache_db()
+            row = db.execute("SELECT LENGTH(CAST(text AS BLOB)) FROM transcripts WHERE hash = ?", (key,)).fetchone()
+            db.execute("INSERT OR REPLACE INTO transcripts VALUES (?, ?, ?)", (key, text, time.time_ns()))
+            cache_size += len(text.encode()) - (row[0] if row else 0)
+            
+            # Evict the oldest entries a few at a time, using the ts index
+            while cache_size > CACHE_SIZE_LIMIT:
+                oldest = db.execute("SELECT hash, LENGTH(CAST(text AS BLOB)) FROM transcripts ORDER BY ts LIMIT 64").fetchall()
+                if not oldest:
+                    break
+                for old_key, size in oldest:
+                    if cache_size <= CACHE_SIZE_LIMIT:
+                        break
+                    db.execute("DELETE FROM transcripts WHERE hash = ?", (old_key,))
+                    cache_size -= size
+            db.commit()
+    except (sqlite3.Error, OSError) as e:
+        print(f"Transcript cache unavailable: {e}")
+
+def hash_file(path):
+    """Hash a file's content in fixed-size blocks"""
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return f"file:{digest.hexdigest()}"
+
+def hash_audio_data(audio_data):
+    """Hash decoded PCM together with its format"""
+    digest = hashlib.blake2b(audio_data.frame_data)
+    return f"pcm:{audio_data.sample_rate}:{audio_data.sample_width}:{digest.hexdigest()}"
+
+def cached_transcription(transcribe):
+    """Reuse the stored transcription of a file whose content was seen before"""
+    @functools.wraps(transcribe)
+    def wrapper(filename):
+        try:
+            key = hash_file(filename)
+        except OSError as e:
+            print(f"Error hashing file: {e}")
+            return transcribe(filename)
         
+        text = cache_get(key)
+        if text is not None:
+            print("✓ Using cached transcription")
+            return text
+        
+        text = transcribe(filename)
+        if text:
+            cache_set(key, text)
+        return text
+    return wrapper
+
+def extract_audio_from_video(video_path):
+    """Extract audio from video file into memory using ffmpeg"""
+    try:
         print("Extracting audio from video...")
-        # Use ffmpeg to extract audio and convert to WAV
-        (
+        # Pipe raw 16 kHz mono PCM to stdout instead of writing a temporary WAV;
+        # -vn/-sn/-dn keep ffmpeg from decoding anything but the audio stream
+        process = (
             ffmpeg
-            .input(video_path)
-            .output(temp_audio_path, ac=1, ar=16000, acodec='pcm_s16le')
-            .overwrite_output()
-            .run(quiet=True, capture_stdout=True, capture_stderr=True)
+            .input(video_path, threads=0)
+            .output('pipe:', format='s16le', ac=1, ar=SAMPLE_RATE, acodec='pcm_s16le', vn=None, sn=None, dn=None)
+            .run_async(pipe_stdout=True, pipe_stderr=True)
         )
+        pcm_bytes, stderr = process.communicate()
+        if process.returncode != 0:
+            raise ffmpeg.Error('ffmpeg', pcm_bytes, stderr)
+        if not pcm_bytes:
+            print("No audio stream found in video")
+            return None
         
-        return temp_audio_path
+        return sr.AudioData(pcm_bytes, SAMPLE_RATE, SAMPLE_WIDTH)
     except ffmpeg.Error as e:
         print(f"FFmpeg error: {e.stderr.decode() if e.stderr else 'Unknown error'}")
         return None
@@ -37,267 +237,618 @@ def extract_audio_from_video(video_path):
         print(f"Error extracting audio from video: {e}")
         return None
 
+def is_mono_pcm_wav(audio_path):
+    """Check whether a WAV file can be fed to the recognizer without conversion"""
+    try:
+        with wave.open(audio_path, 'rb') as wf:
+            # 16-bit only: 8-bit WAV samples are unsigned, AudioData expects signed
+            return wf.getnchannels() == 1 and wf.getsampwidth() == SAMPLE_WIDTH
+    except (wave.Error, EOFError):
+        return False
+
+def write_pcm_wav(audio_path, wav_path):
+    """Decode audio_path to a 16 kHz mono WAV at wav_path, removing it if anything fails"""
+    # Decode to 16 kHz mono PCM and copy it to disk in fixed-size blocks,
+    # so memory stays bounded regardless of the input length
+    process = (
+        ffmpeg
+        .input(audio_path)
+        .output('pipe:', format='s16le', ac=1, ar=SAMPLE_RATE, acodec='pcm_s16le')
+        .global_args('-loglevel', 'error')
+        .run_async(pipe_stdout=True, pipe_stderr=True)
+    )
+    # Drain stderr alongside stdout, otherwise a damaged file that logs a lot
+    # fills the stderr pipe and ffmpeg blocks while we wait on stdout
+    stderr_tail = deque(maxlen=FFMPEG_STDERR_TAIL)
+    stderr_reader = threading.Thread(target=stderr_tail.extend, args=(process.stderr,), daemon=True)
+    stderr_reader.start()
+    try:
+        with wave.open(wav_path, 'wb') as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(SAMPLE_WIDTH)
+            wf.setframerate(SAMPLE_RATE)
+            while True:
+                block = process.stdout.read(COPY_BUFFER_SIZE)
+                if not block:
+                    break
+                wf.writeframesraw(block)
+        
+        returncode = process.wait()
+        stderr_reader.join()
+        if returncode != 0:
+            raise ffmpeg.Error('ffmpeg', None, b''.join(stderr_tail))
+    except BaseException:
+        process.kill()
+        process.wait()
+        stderr_reader.join()
+        if os.path.exists(wav_path):
+            os.unlink(wav_path)
+        raise
+
 def convert_audio_to_wav(audio_path):
-    """Convert any audio file to WAV format using pydub"""
+    """Convert any audio file to WAV format by streaming it through ffmpeg"""
     try:
         file_ext = os.path.splitext(audio_path)[1].lower()
         
-        # If already WAV, return as is
-        if file_ext == '.wav':
+        # If already 16-bit mono PCM WAV, return as is
+        if file_ext == '.wav' and is_mono_pcm_wav(audio_path):
             return audio_path
         
         print(f"Converting {file_ext} to WAV...")
         
-        # Load audio file based on format
-        if file_ext == '.mp3':
-            audio = AudioSegment.from_mp3(audio_path)
-        elif file_ext == '.flac':
-            audio = AudioSegment.from_file(audio_path, "flac")
-        elif file_ext == '.m4a':
-            audio = AudioSegment.from_file(audio_path, "m4a")
-        elif file_ext == '.aac':
-            audio = AudioSegment.from_file(audio_path, "aac")
-        else:
-            # Try generic file loading
-            audio = AudioSegment.from_file(audio_path)
-        
-        # Create temporary WAV file
-        temp_wav = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-        temp_wav_path = temp_wav.name
-        temp_wav.close()
-        
-        # Export as WAV with optimized settings for speech recognition
-        audio = audio.set_frame_rate(16000).set_channels(1)
-        audio.export(temp_wav_path, format="wav")
-        return temp_wav_path
+        # tmpfs can be small (64 MB in Docker), so retry on disk when it fills up
+        roots = [WORKSPACE_ROOT, ''] if WORKSPACE_ROOT else ['']
+        for root in roots:
+            temp_wav_path = os.path.join(get_workspace(root), f"{uuid.uuid4().hex}.wav")
+            try:
+                write_pcm_wav(audio_path, temp_wav_path)
+                return temp_wav_path
+            except OSError as e:
+                if e.errno != errno.ENOSPC or root == roots[-1]:
+                    raise
+                print(f"Not enough space in {root}, using the disk temp directory...")
         
+    except ffmpeg.Error as e:
+        print(f"FFmpeg error: {e.stderr.decode() if e.stderr else 'Unknown error'}")
+        return None
     except Exception as e:
         print(f"Error converting audio file: {e}")
         return None
 
 def split_audio_file(audio_path, chunk_length_ms=30000):
-    """Split large audio file into smaller chunks"""
+    """Split large audio file into smaller in-memory chunks, reading one chunk at a time"""
     try:
         print("Splitting audio file into chunks...")
-        audio = AudioSegment.from_wav(audio_path)
-        chunks = []
-        
-        # Split audio into chunks
-        for i in range(0, len(audio), chunk_length_ms):
-            chunk = audio[i:i + chunk_length_ms]
-            chunk_file = tempfile.NamedTemporaryFile(delete=False, suffix=f'_chunk_{i//1000}.wav')
-            chunk_path = chunk_file.name
-            chunk_file.close()
-            chunk.export(chunk_path, format="wav")
-            chunks.append(chunk_path)
-        
-        return chunks
+        wf = wave.open(audio_path, 'rb')
     except Exception as e:
         print(f"Error splitting audio file: {e}")
-        return [audio_path]  # Return original file if splitting fails
+        yield audio_path  # Return original file if splitting fails
+        return
+    
+    # Only the chunk being handed out is resident, never the whole decoded file
+    with wf:
+        frames_per_chunk = chunk_length_ms * wf.getframerate() // 1000
+        while True:
+            frames = wf.readframes(frames_per_chunk)
+            if not frames:
+                break
+            yield sr.AudioData(frames, wf.getframerate(), wf.getsampwidth())
 
-def transcribe_with_fallback(audio_path):
-    """Try multiple speech recognition services with fallbacks"""
-    transcription = ""
+def transcribe_with_whisper(audio_data):
+    """Transcribe in-memory audio of any length with the local Whisper model, or return None"""
+    pipeline = get_whisper_pipeline()
+    if not pipeline:
+        return None
+    
+    key = hash_audio_data(audio_data)
+    text = cache_get(key)
+    if text is not None:
+        return text
     
-    #Google Speech Recognition
     try:
-        print("Trying Google Speech Recognition...")
-        with sr.AudioFile(audio_path) as source:
-            recognizer.adjust_for_ambient_noise(source, duration=0.5)
-            audio_data = recognizer.record(source)
+        print("Trying Whisper...")
+        pcm = audio_data.get_raw_data(convert_rate=SAMPLE_RATE, convert_width=SAMPLE_WIDTH)
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+        segments, _ = pipeline.transcribe(samples, beam_size=5, vad_filter=True, batch_size=WHISPER_BATCH_SIZE)
+        text = " ".join(segment.text.strip() for segment in segments)
+        print("✓ Whisper successful")
+        cache_set(key, text)
+        return text
+    except Exception as e:
+        print(f"Whisper failed: {e}")
+        return None
+
+def recognize_with_fallback(audio_data):
+    """Try multiple speech recognition services on in-memory audio with fallbacks"""
+    key = hash_audio_data(audio_data)
+    text = cache_get(key)
+    if text is not None:
+        return text
+    
+    # A recognizer per call keeps this safe to run from worker threads
+    recognizer = sr.Recognizer()
+    
+    with transcription_slots:
+        #Google Speech Recognition
+        try:
+            print("Trying Google Speech Recognition...")
             text = recognizer.recognize_google(audio_data)
             print("✓ Google Speech Recognition successful")
+            cache_set(key, text)
             return text
-    except Exception as e:
-        print(f"Google Speech Recognition failed: {e}")
-    
-    #Then, Google Cloud Speech
-    try:
-        print("Trying Google Cloud Speech...")
-        with sr.AudioFile(audio_path) as source:
-            audio_data = recognizer.record(source)
+        except Exception as e:
+            print(f"Google Speech Recognition failed: {e}")
+        
+        #Then, Google Cloud Speech
+        try:
+            print("Trying Google Cloud Speech...")
             # You would need to set up GOOGLE_APPLICATION_CREDENTIALS for this
             text = recognizer.recognize_google_cloud(audio_data)
             print("✓ Google Cloud Speech successful")
+            cache_set(key, text)
             return text
+        except Exception as e:
+            print(f"Google Cloud Speech failed: {e}")
+
+def read_audio_file(audio_path):
+    """Read a whole WAV file into AudioData, or return None if it cannot be read"""
+    try:
+        with sr.AudioFile(audio_path) as source:
+            return sr.Recognizer().record(source)
     except Exception as e:
-        print(f"Google Cloud Speech failed: {e}")
+        print(f"Error reading audio file: {e}")
+        return None
+
+def transcribe_with_fallback(audio):
+    """Try multiple speech recognition services with fallbacks on a file path or AudioData"""
+    if not isinstance(audio, sr.AudioData):
+        audio = read_audio_file(audio)
+        if audio is None:
+            return None
+    
+    return recognize_with_fallback(audio)
+
+def transcribe_chunks(chunks, transcribe, total=None):
+    """Transcribe chunks concurrently, returning the texts in their original order"""
+    def transcribe_chunk(indexed_chunk):
+        i, chunk = indexed_chunk
+        print(f"Transcribing chunk {i+1}/{total}..." if total else f"Transcribing chunk {i+1}...")
+        return transcribe(chunk)
+    
+    results = []
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=TRANSCRIBE_CONCURRENCY) as executor:
+        # Sliding window of futures: lazily read chunks stay bounded in memory, and
+        # there is a spare chunk per worker so one slow request does not idle the rest
+        for indexed_chunk in enumerate(chunks):
+            if len(in_flight) >= 2 * TRANSCRIBE_CONCURRENCY:
+                results.append(in_flight.popleft().result())
+            in_flight.append(executor.submit(transcribe_chunk, indexed_chunk))
+        results.extend(future.result() for future in in_flight)
+    
+    return results
+
+def batch_recognize(chunks):
+    """Transcribe WAV paths or AudioData with a single Google Cloud BatchRecognize request"""
+    bucket = storage.Client(project=GOOGLE_CLOUD_PROJECT).bucket(GCS_BUCKET)
+    prefix = f"chartie/{uuid.uuid4().hex}"
+    blobs = [bucket.blob(f"{prefix}/chunk_{i}.wav") for i in range(len(chunks))]
+    
+    def upload_chunk(blob, chunk):
+        if isinstance(chunk, sr.AudioData):
+            blob.upload_from_string(chunk.get_wav_data(), content_type='audio/wav')
+        else:
+            blob.upload_from_filename(chunk, content_type='audio/wav')
     
+    try:
+        # Upload all chunks in parallel before submitting the batch
+        with ThreadPoolExecutor(max_workers=TRANSCRIBE_CONCURRENCY) as executor:
+            list(executor.map(upload_chunk, blobs, chunks))
+        
+        uris = [f"gs://{GCS_BUCKET}/{blob.name}" for blob in blobs]
+        strategy = speech_v2.BatchRecognizeRequest.ProcessingStrategy
+        request = speech_v2.BatchRecognizeRequest(
+            recognizer=f"projects/{GOOGLE_CLOUD_PROJECT}/locations/global/recognizers/_",
+            config=speech_v2.RecognitionConfig(
+                auto_decoding_config=speech_v2.AutoDetectDecodingConfig(),
+                language_codes=['en-US'],
+                model='long',
+            ),
+            files=[speech_v2.BatchRecognizeFileMetadata(uri=uri) for uri in uris],
+            recognition_output_config=speech_v2.RecognitionOutputConfig(
+                gcs_output_config=speech_v2.GcsOutputConfig(uri=f"gs://{GCS_BUCKET}/{prefix}/results"),
+            ),
+            processing_strategy=strategy.DYNAMIC_BATCHING if BATCH_RECOGNIZE_DYNAMIC else strategy.PROCESSING_STRATEGY_UNSPECIFIED,
+        )
+        operation = speech_v2.SpeechClient().batch_recognize(request=request)
+        response = operation.result(timeout=BATCH_RECOGNIZE_TIMEOUT)
+        
+        texts = []
+        for uri in uris:
+            file_result = response.results[uri]
+            if file_result.error.code:
+                raise RuntimeError(f"{uri}: {file_result.error.message}")
+            
+            result_blob = storage.Blob.from_string(file_result.cloud_storage_result.uri, client=bucket.client)
+            results = speech_v2.BatchRecognizeResults.from_json(result_blob.download_as_bytes(), ignore_unknown_fields=True)
+            texts.append(" ".join(r.alternatives[0].transcript.strip() for r in results.results if r.alternatives))
+        return texts
+    finally:
+        for blob in bucket.list_blobs(prefix=prefix):
+            blob.delete()
+
+def transcribe_with_batch_recognize(audio):
+    """Transcribe whole audio with one BatchRecognize operation, or return None when unavailable"""
+    if speech_v2 is None or not (GOOGLE_CLOUD_PROJECT and GCS_BUCKET):
+        return None
+    
+    try:
+        if isinstance(audio, sr.AudioData):
+            duration_ms = len(audio.frame_data) * 1000 // (audio.sample_rate * audio.sample_width)
+        else:
+            with wave.open(audio, 'rb') as wf:
+                duration_ms = wf.getnframes() * 1000 // wf.getframerate()
+        if duration_ms > BATCH_RECOGNIZE_MAX_MS:
+            print("Audio exceeds the BatchRecognize length limit, splitting into chunks...")
+            return None
+        
+        # One long file keeps a single operation in flight instead of waiting on one per chunk group
+        print("Submitting audio to Google Cloud BatchRecognize...")
+        text = batch_recognize([audio])[0]
+        print("✓ Google Cloud BatchRecognize successful")
+        return text
+    except Exception as e:
+        print(f"Google Cloud BatchRecognize failed: {e}")
+        return None
+
+def transcribe_chunk_stream(chunks, total=None):
+    """Transcribe chunks with one request per chunk and join the results in order"""
+    results = transcribe_chunks(chunks, transcribe_with_fallback, total)
+    return " ".join(text.strip() for text in results if text)
 
 def transcribe_audio_file(audio_path):
     """Transcribe audio file with chunking and multiple fallbacks"""
     try:
+        # Whisper handles long audio itself, so it gets the whole file first
+        if get_whisper_pipeline():
+            audio_data = read_audio_file(audio_path)
+            text = transcribe_with_whisper(audio_data) if audio_data is not None else None
+            if text is not None:
+                return text
+        
         # Check file size and split if necessary
         file_size = os.path.getsize(audio_path)
-        max_size = 10 * 1024 * 1024  # 10MB limit for Google Speech Recognition
         
-        if file_size > max_size:
+        if file_size > MAX_AUDIO_SIZE:
+            text = transcribe_with_batch_recognize(audio_path)
+            if text is not None:
+                return text
+            
             print("File too large, splitting into chunks...")
             chunks = split_audio_file(audio_path)
-            full_transcription = ""
+            return transcribe_chunk_stream(chunks)
+        else:
+            return transcribe_with_fallback(audio_path)
             
-            for i, chunk_path in enumerate(chunks):
-                print(f"Transcribing chunk {i+1}/{len(chunks)}...")
-                chunk_text = transcribe_with_fallback(chunk_path)
-                full_transcription += " " + chunk_text
-                
-                # Clean up chunk file
-                if chunk_path != audio_path:
-                    os.unlink(chunk_path)
+    except Exception as e:
+        print(f"Error during transcription: {e}")
+        return ""
+
+def transcribe_audio_data(audio_data, chunk_length_ms=30000):
+    """Transcribe in-memory audio with chunking and multiple fallbacks"""
+    try:
+        # Whisper handles long audio itself, the Google services need chunks
+        text = transcribe_with_whisper(audio_data)
+        if text is not None:
+            return text
+        
+        if len(audio_data.frame_data) > MAX_AUDIO_SIZE:
+            text = transcribe_with_batch_recognize(audio_data)
+            if text is not None:
+                return text
             
-            return full_transcription.strip()
+            print("Audio too large, splitting into chunks...")
+            duration_ms = len(audio_data.frame_data) * 1000 // (audio_data.sample_rate * audio_data.sample_width)
+            starts = range(0, duration_ms, chunk_length_ms)
+            chunks = (audio_data.get_segment(start, start + chunk_length_ms) for start in starts)
+            return transcribe_chunk_stream(chunks, len(starts))
         else:
-            return transcribe_with_fallback(audio_path)
+            return recognize_with_fallback(audio_data)
             
     except Exception as e:
         print(f"Error during transcription: {e}")
         return ""
 
-def transcribe_media_file(filename):
-    """Transcribe media file (video or audio)"""
+def decode_media_file(filename):
+    """Decode media file to in-memory AudioData (video) or a WAV path (audio)"""
     file_ext = os.path.splitext(filename)[1].lower()
     
     # Handle video files
     video_extensions = {'.mp4', '.avi', '.mkv', '.mov', '.wmv'}
     if file_ext in video_extensions:
-        temp_audio_path = extract_audio_from_video(filename)
-        if not temp_audio_path:
-            return ""
-        
-        try:
-            transcription = transcribe_audio_file(temp_audio_path)
-            return transcription
-        finally:
-            # Clean up temporary audio file
-            if os.path.exists(temp_audio_path):
-                os.unlink(temp_audio_path)
+        return extract_audio_from_video(filename)
     
     # Handle audio files
     else:
-        wav_path = convert_audio_to_wav(filename)
-        if not wav_path:
-            return ""
-        
-        try:
-            transcription = transcribe_audio_file(wav_path)
-            return transcription
-        finally:
-            # Clean up temporary WAV file if it was created
-            if wav_path != filename and os.path.exists(wav_path):
-                os.unlink(wav_path)
-
-# Get and transcribe the file
-while True:
-    filename = input("Enter path to your video/audio file (Add extension): ").strip()
-    
-    if not os.path.isfile(filename):
-        print(f"Error: File '{filename}' not found. Please try again.")
-        continue
-    
-    # Check if file has a media extension
-    file_ext = os.path.splitext(filename)[1].lower()
-    if file_ext not in MEDIA_EXTENSIONS:
-        response = input(f"Warning: '{file_ext}' is not a common media extension. Continue anyway? (y/n): ")
-        if response.lower() != 'y':
-            continue
+        return convert_audio_to_wav(filename)
+
+def transcribe_decoded_audio(filename, audio):
+    """Transcribe the output of decode_media_file"""
+    if isinstance(audio, sr.AudioData):
+        return transcribe_audio_data(audio)
     
-    break
+    try:
+        transcription = transcribe_audio_file(audio)
+        return transcription
+    finally:
+        # Clean up temporary WAV file if it was created
+        if audio != filename and os.path.exists(audio):
+            os.unlink(audio)
 
-# Transcribe the file
-print(f"Processing file: {filename}")
-transcribed_text = transcribe_media_file(filename)
+@cached_transcription
+def transcribe_media_file(filename):
+    """Transcribe media file (video or audio)"""
+    audio = decode_media_file(filename)
+    if not audio:
+        return ""
+    
+    return transcribe_decoded_audio(filename, audio)
 
-if not transcribed_text:
-    print("\n" + "="*50)
-    print("TRANSCRIPTION FAILED")
-    print("Possible reasons:")
-    print("1. Network connection issues")
-    print("2. Audio file too long or too large")
-    print("3. Poor audio quality")
-    print("4. Service limitations")
-    print("="*50)
+async def transcribe_media_files(filenames, decode_workers, asr_workers):
+    """Transcribe many files, overlapping ffmpeg decoding of some with recognition of others"""
+    # Decoding is CPU-bound and recognition network-bound, so each stage gets its own threads
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=decode_workers + asr_workers))
+    decode_queue = asyncio.Queue()
+    # Bounded so decoded audio cannot pile up faster than it is recognized
+    asr_queue = asyncio.Queue(maxsize=asr_workers)
+    transcriptions = {}
     
-    # Provide manual input option
-    print("\nSince transcription failed, you can:")
-    print("1. Enter the transcription manually")
-    print("2. Try again with a different file")
-    print("3. Use the Q&A system with custom text")
+    for filename in filenames:
+        decode_queue.put_nowait(filename)
     
-    choice = input("Enter your choice (1/2/3): ").strip()
+    async def decode_worker():
+        while True:
+            filename = await decode_queue.get()
+            try:
+                key = await asyncio.to_thread(hash_file, filename)
+                cached = await asyncio.to_thread(cache_get, key)
+                if cached is not None:
+                    print(f"✓ Using cached transcription for {filename}")
+                    transcriptions[filename] = cached
+                    continue
+                
+                print(f"Processing file: {filename}")
+                audio = await asyncio.to_thread(decode_media_file, filename)
+                if not audio:
+                    transcriptions[filename] = ""
+                    continue
+                await asr_queue.put((filename, key, audio))
+            except Exception as e:
+                print(f"Error processing {filename}: {e}")
+                transcriptions[filename] = ""
+            finally:
+                decode_queue.task_done()
     
-    if choice == "1":
-        transcribed_text = input("Paste the transcription text here: ").strip()
-    elif choice == "2":
-        print("Please restart the script with a different file.")
-        exit()
-    elif choice == "3":
-        transcribed_text = "No transcription available. Please ask general questions."
-    else:
-        print("Invalid choice. Exiting.")
-        exit()
+    async def asr_worker():
+        while True:
+            filename, key, audio = await asr_queue.get()
+            try:
+                text = await asyncio.to_thread(transcribe_decoded_audio, filename, audio)
+                if text:
+                    await asyncio.to_thread(cache_set, key, text)
+                transcriptions[filename] = text or ""
+            except Exception as e:
+                print(f"Error transcribing {filename}: {e}")
+                transcriptions[filename] = ""
+            finally:
+                asr_queue.task_done()
+    
+    workers = [asyncio.create_task(decode_worker()) for _ in range(decode_workers)]
+    workers += [asyncio.create_task(asr_worker()) for _ in range(asr_workers)]
+    await decode_queue.join()
+    await asr_queue.join()
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    
+    return [transcriptions.get(filename, "") for filename in filenames]
 
-# Format the transcription
-if transcribed_text:
-    sentences = transcribed_text.split('.')
-    transcription = '\n'.join([(f"{i+1}. {t.strip()}") for i,t in enumerate(sentences) if t.strip()])
-    print(f"\nThis is the transcription of your file, {filename}.\n\n{transcription}\n")
+def format_transcription(transcribed_text):
+    """Number each sentence of the transcription on its own line"""
+    buf = io.StringIO()
+    n = 0
+    # One pass that strips each sentence once and writes straight into the buffer
+    for t in SENTENCE_BOUNDARY.split(transcribed_text):
+        sentence = t.strip()
+        if not sentence:
+            continue
+        if n:
+            buf.write('\n')
+        n += 1
+        buf.write(str(n))
+        buf.write('. ')
+        buf.write(sentence)
+    return buf.getvalue()
 
+def ask_questions(transcription):
+    """Answer questions about the transcription through the chat API"""
     # Q&A loop with the transcription as context
     print("\n" + "="*50)
     print("You can now ask questions about the transcription!")
     print("Type 'quit' to exit.")
     print("="*50)
 
-    while True:
-        try:
-            user_input = input('\nYou: ').strip()
+    # The transcription goes in a system message that stays identical every turn,
+    # so the server-side prompt cache can reuse it and only the question is new
+    system_prompt = f"""You are a helpful assistant that answers questions based on the following transcription. If a statement is entered you can give answers whether it is true or false base on transcript or your own research. 
+    If the answer cannot be found in the transcription, say "I cannot find that information in the transcription, but based on what i know", then answer the question
+    
+    Transcription:
+    {transcription}"""
+    answer_cache = OrderedDict()
+
+    # One client for the whole session keeps the connection to the server alive between questions
+    transport = httpx.HTTPTransport(uds=CHAT_API_SOCKET) if CHAT_API_SOCKET else None
+    session = httpx.Client(base_url=CHAT_API_URL, transport=transport, timeout=60)
+
+    try:
+        while True:
+            try:
+                user_input = input('\nYou: ').strip()
             
-            if user_input.lower() in ['quit', 'exit', 'bye']:
-                print("Goodbye!")
-                break
+                if user_input.lower() in ['quit', 'exit', 'bye']:
+                    print("Goodbye!")
+                    break
                 
-            if not user_input:
-                continue
-            
-            # Prepare the message with system prompt and transcription context
-            system_prompt = f"""You are a helpful assistant that answers questions based on the following transcription. If a statement is entered you can give answers whether it is true or false base on transcript or your own research. 
-            If the answer cannot be found in the transcription, say "I cannot find that information in the transcription, but based on what i know", then answer the question
-            
-            Transcription:
-            {transcription}
-            
-            Question: {user_input}
-            Answer:"""
-            
-            data = {'message': system_prompt}
+                if not user_input:
+                    continue
+                
+                # Repeated questions are answered from the session cache
+                key = hashlib.sha256(f"{system_prompt}\0{user_input}".encode()).hexdigest()
+                if key in answer_cache:
+                    answer_cache.move_to_end(key)
+                    print(f"\nAgent: {answer_cache[key]}")
+                    continue
             
-            # Make sure to send proper JSON with correct headers
-            headers = {'Content-Type': 'application/json'}
-            response = requests.post('http://127.0.0.1:8000/api/v1/chat/', json=data, headers=headers)
+                data = {'system': system_prompt, 'message': user_input}
             
-            if response.status_code == 200:
-                response_data = response.json()
-                # Handle different response formats
-                if isinstance(response_data, dict):
-                    if 'response' in response_data:
-                        print(f"\nAgent: {response_data['response']}")
-                    elif 'error' in response_data:
-                        print(f"\nAgent Error: {response_data['error']}")
-                    else:
-                        print(f"\nAgent: {response_data}")
-                else:
-                    print(f"\nAgent: {response_data}")
-            else:
-                print(f"Error: Received status code {response.status_code}")
-                print("Response content:", response.text)
+                # Print the answer token by token as the server streams it
+                with session.stream('POST', '/api/v1/chat/', json=data) as response:
+                    if response.status_code != 200:
+                        response.read()
+                        print(f"Error: Received status code {response.status_code}")
+                        print("Response content:", response.text)
+                        continue
+                    
+                    print("\nAgent: ", end="", flush=True)
+                    answer = []
+                    completed = False
+                    for line in response.iter_lines():
+                        if not line.startswith('data: '):
+                            continue
+                        payload = line[len('data: '):]
+                        if payload == '[DONE]':
+                            completed = True
+                            break
+                        
+                        event = json.loads(payload)
+                        if 'response' in event:
+                            answer.append(event['response'])
+                            print(event['response'], end="", flush=True)
+                        elif 'error' in event:
+                            print(f"Error: {event['error']}", end="")
+                            break
+                    print()
                 
-        except requests.exceptions.ConnectionError:
-            print("Error: Cannot connect to server. Please ensure the server is running.")
-        except requests.exceptions.RequestException as e:
-            print(f"Request error: {e}")
-        except KeyboardInterrupt:
-            print("\nGoodbye!")
-            break
-        except Exception as e:
-            print(f"Unexpected error: {e}")
\ No newline at end of file
+                if completed and answer:
+                    answer_cache[key] = "".join(answer)
+                    if len(answer_cache) > ANSWER_CACHE_SIZE:
+                        answer_cache.popitem(last=False)
+                
+            except httpx.ConnectError:
+                print("Error: Cannot connect to server. Please ensure the server is running.")
+            except httpx.HTTPError as e:
+                print(f"Request error: {e}")
+            except KeyboardInterrupt:
+                print("\nGoodbye!")
+                break
+            except Exception as e:
+                print(f"Unexpected error: {e}")
+    finally:
+        session.close()
+
+def run_interactive():
+    """Prompt for a single file, transcribe it and start the Q&A loop"""
+    # Get and transcribe the file
+    while True:
+        filename = input("Enter path to your video/audio file (Add extension): ").strip()
+        
+        if not os.path.isfile(filename):
+            print(f"Error: File '{filename}' not found. Please try again.")
+            continue
+        
+        # Check if file has a media extension
+        file_ext = os.path.splitext(filename)[1].lower()
+        if file_ext not in MEDIA_EXTENSIONS:
+            response = input(f"Warning: '{file_ext}' is not a common media extension. Continue anyway? (y/n): ")
+            if response.lower() != 'y':
+                continue
+        
+        break
+    
+    # Transcribe the file
+    print(f"Processing file: {filename}")
+    transcribed_text = transcribe_media_file(filename)
+    print(f"Transcript cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    
+    if not transcribed_text:
+        print("\n" + "="*50)
+        print("TRANSCRIPTION FAILED")
+        print("Possible reasons:")
+        print("1. Network connection issues")
+        print("2. Audio file too long or too large")
+        print("3. Poor audio quality")
+        print("4. Service limitations")
+        print("="*50)
+    
+        # Provide manual input option
+        print("\nSince transcription failed, you can:")
+        print("1. Enter the transcription manually")
+        print("2. Try again with a different file")
+        print("3. Use the Q&A system with custom text")
+    
+        choice = input("Enter your choice (1/2/3): ").strip()
+    
+        if choice == "1":
+            transcribed_text = input("Paste the transcription text here: ").strip()
+        elif choice == "2":
+            print("Please restart the script with a different file.")
+            return
+        elif choice == "3":
+            transcribed_text = "No transcription available. Please ask general questions."
+        else:
+            print("Invalid choice. Exiting.")
+            return
+    
+    # Format the transcription
+    if transcribed_text:
+        transcription = format_transcription(transcribed_text)
+        print(f"\nThis is the transcription of your file, {filename}.\n\n{transcription}\n")
+        ask_questions(transcription)
+
+def run_batch(patterns, decode_workers, asr_workers):
+    """Transcribe every file matching the given paths or glob patterns"""
+    # Existing files are taken literally so names like talk[1].mp3 aren't read as patterns
+    filenames = sorted({
+        path
+        for pattern in patterns
+        for path in ([pattern] if os.path.isfile(pattern) else glob.glob(pattern, recursive=True))
+        if os.path.isfile(path)
+    })
+    if not filenames:
+        print("Error: No files matched.")
+        return
+    
+    transcriptions = asyncio.run(transcribe_media_files(filenames, decode_workers, asr_workers))
+    print(f"Transcript cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    
+    for filename, transcribed_text in zip(filenames, transcriptions):
+        if transcribed_text:
+            print(f"\nThis is the transcription of your file, {filename}.\n\n{format_transcription(transcribed_text)}\n")
+        else:
+            print(f"\nTRANSCRIPTION FAILED for {filename}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe video/audio files and ask questions about them.")
+    parser.add_argument('--files', nargs='+', metavar='PATH', help="files or glob patterns to transcribe in batch; prompts for one file when omitted")
+    parser.add_argument('--decode-workers', type=int, default=os.cpu_count() or 1, help="parallel ffmpeg decodes (default: CPU count)")
+    parser.add_argument('--asr-workers', type=int, default=TRANSCRIBE_CONCURRENCY, help="files transcribed at once (default: TRANSCRIBE_CONCURRENCY)")
+    args = parser.parse_args()
+    
+    if args.files:
+        run_batch(args.files, args.decode_workers, args.asr_workers)
+    else:
+        run_interactive()
+
+if __name__ == '__main__':
+    main()